@@ -1,35 +1,109 @@
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date as Date
+from functools import cache, partial
+from itertools import repeat
+import logging
+import os
 import time
 import random
 import sys
 import msvcrt
 from pathlib import Path
-from typing import Union, Iterator
+from collections.abc import Iterable, Iterator
 import xlwings as xl
 import re
 
-sheet_name: str = open('sheet_name.secret.txt', encoding='utf-8').readline()
+log = logging.getLogger(__name__)
 
+_SHEET_RE = re.compile(r'Registos de Produção PV (.+?)\.xlsx')
+_LINE_RE = re.compile(r'\[(\d+)-(\d+)-(\d+)]: (\S+)')
 
-def export_to_excel(report_dir: str, excel_dirs: [str]):
+_DEFAULT_EXCEL_JOBS = 2
+_MAX_WINDOWS_JOBS = 61
+
+
+def export_to_excel(report_dir: str, excel_dirs: [str], jobs: int | None = None, interactive: bool = False):
     """
     Reads the report files and writes each of them into the excel sheets.
     Assumes that the reports are from this month.
+    When interactive, waits before each station until a key is pressed or the timeout runs out,
+    processing the stations one at a time in a single worker so they all share the console.
+    Defaults to a couple of workers rather than one per cpu, since every worker starts its own excel instance.
+    """
+    if interactive:
+        jobs = 1
+    worker = partial(_export_to_excel, interactive=interactive)
+    run_in_workers(worker, report_dir, excel_dirs, _DEFAULT_EXCEL_JOBS if jobs is None else jobs)
+
+
+def _export_to_excel(report_dir: str, stations: [tuple[str, Path]], interactive: bool):
+    """
+    Worker for `export_to_excel`, each worker process runs its own excel instance.
     """
+    load_sheet_name()
     app: xl.App
     with xl.App(add_book=False) as app:
-        for station, excel_path in report_sheets(excel_dirs):
+        for station, excel_path in stations:
             try:
                 report_path = Path(report_dir) / f'{station}.log'
                 station = report_path.stem
 
-                wait_or_timeout(random.randint(60, 90))
-                print('processing', station)
+                if interactive:
+                    wait_or_timeout(random.randint(60, 90))
+                log.info('processing %s', station)
 
                 records = read_report(report_path)
-                write_report(app, excel_path, list(records))
+                write_report(app, excel_path, records)
             except FileNotFoundError:
-                print('no report found for station', station)
+                log.warning('no report found for station %s', station)
+
+
+def export_to_values(report_dir: str, excel_dirs: [str], values_dir: str, jobs: int | None = None):
+    """
+    Reads the report files and writes each of them into a new values only workbook inside the given directory.
+    Skips excel entirely, so none of the formatting of the report sheets is kept.
+    """
+    Path(values_dir).mkdir(parents=True, exist_ok=True)
+    run_in_workers(partial(_export_to_values, values_dir=values_dir), report_dir, excel_dirs, jobs)
+
+
+def _export_to_values(report_dir: str, stations: [tuple[str, Path]], values_dir: str):
+    """
+    Worker for `export_to_values`.
+    """
+    load_sheet_name()
+    for station, _ in stations:
+        try:
+            report_path = Path(report_dir) / f'{station}.log'
+            station = report_path.stem
+
+            log.info('processing %s', station)
+
+            records = read_report(report_path)
+            write_values(Path(values_dir) / f'{station}.xlsx', records)
+        except FileNotFoundError:
+            log.warning('no report found for station %s', station)
+
+
+def run_in_workers(worker, report_dir: str, excel_dirs: [str], jobs: int | None):
+    """
+    Splits the report sheets found in the given directories between worker processes, defaulting to one per cpu.
+    The worker is called with the report directory and its share of the stations.
+    """
+    if jobs is not None and jobs < 1:
+        raise ValueError(f'jobs must be at least 1, got {jobs}')
+
+    stations = list(report_sheets(excel_dirs))
+    if not stations:
+        return
+
+    jobs = min(jobs or os.cpu_count() or 1, len(stations))
+    if sys.platform == 'win32':
+        jobs = min(jobs, _MAX_WINDOWS_JOBS)
+    batches = [stations[i::jobs] for i in range(jobs)]
+    with ProcessPoolExecutor(max_workers=jobs, initializer=configure_logging) as executor:
+        list(executor.map(worker, repeat(report_dir), batches))
 
 
 def wait_or_timeout(timeout: int = 5):
@@ -47,46 +121,140 @@ def report_sheets(excel_dirs: [str]) -> Iterator[tuple[str, Path]]:
     """
     Finds and yields the name and path of every report sheet inside the given directories
     """
-    pattern = re.compile('Registos de Produção PV (.+?).xlsx')
     for excel_dir in excel_dirs:
-        for path in Path(excel_dir).rglob('*.xlsx'):
-            match = pattern.search(str(path))
-            if match:
-                yield match.group(1), path
+        if not os.path.isdir(excel_dir):
+            raise FileNotFoundError(f'excel directory not found: {excel_dir}')
+        yield from _scan_report_sheets(excel_dir)
+
+
+def _scan_report_sheets(directory: str) -> Iterator[tuple[str, Path]]:
+    """
+    Walks the directory with `os.scandir`, only matching the file names that end in .xlsx.
+    Directories that cannot be read are skipped, like `Path.rglob` does.
+    """
+    try:
+        entries = os.scandir(directory)
+    except PermissionError:
+        log.warning('skipping unreadable directory %s', directory)
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_report_sheets(entry.path)
+            elif entry.name.endswith('.xlsx') and entry.is_file():
+                match = _SHEET_RE.search(entry.name)
+                if match:
+                    yield match.group(1), Path(entry.path)
 
 
 def read_report(report_path: Path) -> Iterator[tuple[Date, float]]:
     """
     Reads the report file and returns its list of records.
     """
-    pattern = re.compile(r'\[(\d+?)-(\d+?)-(\d+?)]: (\S+)')
+    match_line = _LINE_RE.match
     with open(report_path) as report_file:
         for line in report_file:
-            year, month, day, value = pattern.match(line).groups()
+            year, month, day, value = match_line(line).groups()
             yield Date(int(year), int(month), int(day)), to_float(value)
 
 
-def write_report(app: xl.App, excel_path: Path, records: [tuple[Date, float]]):
+def write_report(app: xl.App, excel_path: Path, records: Iterable[tuple[Date, float]]):
     """
     Writes the records to the excel spreadsheet, according to the given date, defaulting to today.
+    The records are grouped before the workbook is opened, so a missing report never leaves it open.
     """
-    options = {'update_links': True, 'ignore_read_only_recommended': True, 'editable': True}
+    columns = group_by_column(records)
+    sheet_name = load_sheet_name()
+
+    options = {'update_links': False, 'ignore_read_only_recommended': True, 'editable': True}
     wb: xl.Book = app.books.open(excel_path, **options)
     sheet: xl.Sheet = wb.sheets[sheet_name]
     sheet.activate()
 
-    for date, value in records:
-        column = offset_month(date)
-        row = offset_day(date)
-        sheet[row, column].value = value
+    screen_updating, display_alerts = app.screen_updating, app.display_alerts
+    app.screen_updating = False
+    app.calculation = 'manual'
+    app.display_alerts = False
+    try:
+        for column, cells in columns.items():
+            for first_row, values in contiguous_runs(cells):
+                sheet[first_row:first_row + len(values), column].value = [[value] for value in values]
 
-    wb.save(excel_path)
+        app.calculate()
+        app.calculation = 'automatic'
+        wb.save()
+    finally:
+        app.display_alerts = display_alerts
+        app.screen_updating = screen_updating
     wb.close()
 
 
-def to_float(value: str) -> Union[float | None]:
+def write_values(excel_path: Path, records: Iterable[tuple[Date, float]]):
     """
-    Parses a float from a str or returns None if parsing fails.
+    Writes the records to a new workbook, in the same cells they would take in the excel spreadsheet.
+    The workbook is saved to a temporary sibling first and then moved over the destination in one step.
+    """
+    from pyexcelerate import Workbook
+
+    columns = group_by_column(records)
+    rows = max((cells[-1][0] + 1 for cells in columns.values()), default=0)
+    grid: list[list[float | None]] = [[None] * (max(columns, default=0) + 1) for _ in range(rows)]
+    for column, cells in columns.items():
+        for row, value in cells:
+            grid[row][column] = value
+
+    wb = Workbook()
+    wb.new_sheet(load_sheet_name(), data=grid)
+    temp_path = excel_path.with_suffix('.xlsx.tmp')
+    wb.save(str(temp_path))
+    os.replace(temp_path, excel_path)
+
+
+def group_by_column(records: Iterable[tuple[Date, float]]) -> dict[int, list[tuple[int, float]]]:
+    """
+    Groups the records by the spreadsheet column they belong to, each sorted by row.
+    """
+    columns: dict[int, list[tuple[int, float]]] = {}
+    for date, value in records:
+        columns.setdefault(offset_month(date), []).append((offset_day(date), value))
+    for cells in columns.values():
+        cells.sort(key=lambda cell: cell[0])
+    return columns
+
+
+def contiguous_runs(cells: [tuple[int, float]]) -> Iterator[tuple[int, list[float]]]:
+    """
+    Splits the sorted cells of a column into runs of consecutive rows, yielding the first row and values of each.
+    Cells missing from the records are left untouched instead of being cleared.
+    """
+    first_row, values = None, []
+    for row, value in cells:
+        if values and row == first_row + len(values) - 1:
+            values[-1] = value
+        elif values and row == first_row + len(values):
+            values.append(value)
+        else:
+            if values:
+                yield first_row, values
+            first_row, values = row, [value]
+    if values:
+        yield first_row, values
+
+
+@cache
+def load_sheet_name() -> str:
+    """
+    Reads the name of the sheet to edit from its secret file, only once per process.
+    Workers call it before their station loop, so a missing file is never mistaken for a missing report.
+    """
+    with open('sheet_name.secret.txt', encoding='utf-8') as file:
+        return file.readline().rstrip('\r\n')
+
+
+def to_float(value: str) -> float:
+    """
+    Parses a float from a str or returns 0.0 if parsing fails.
     """
     try:
         return float(value)
@@ -110,5 +278,54 @@ def offset_month(date: Date) -> int:
     return months + 1
 
 
+def configure_logging():
+    """
+    Sets up logging for the script, in the main process and in each worker process.
+    """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+def positive_int(value: str) -> int:
+    """
+    Parses an int of at least 1 from a command line argument.
+    """
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f'must be at least 1, got {number}')
+    return number
+
+
+def parse_args(args: [str]):
+    """
+    Parses the command line arguments of the script.
+    """
+    parser = ArgumentParser(description='Writes the station reports into their excel sheets.')
+    parser.add_argument('report_dir', help='directory containing the station report logs')
+    parser.add_argument('excel_dirs', nargs='+', help='directories to search for the station excel sheets')
+    parser.add_argument(
+        '--values', metavar='DIR', dest='values_dir',
+        help='write values only workbooks into this directory with pyexcelerate instead of editing the excel sheets',
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=positive_int,
+        help=f'number of stations to process in parallel, each worker editing the excel sheets runs its own excel '
+             f'instance, defaults to {_DEFAULT_EXCEL_JOBS} or to the number of cpus with --values '
+             f'(at most {_MAX_WINDOWS_JOBS} on windows)',
+    )
+    parser.add_argument(
+        '-i', '--interactive', action='store_true',
+        help='wait before each station until a key is pressed or a timeout runs out',
+    )
+    parsed = parser.parse_args(args)
+    if parsed.interactive and parsed.jobs is not None and parsed.jobs > 1:
+        parser.error('--interactive processes one station at a time and cannot be used with --jobs above 1')
+    return parsed
+
+
 if __name__ == '__main__':
-    export_to_excel(sys.argv[1], sys.argv[2:])
+    configure_logging()
+    args = parse_args(sys.argv[1:])
+    if args.values_dir:
+        export_to_values(args.report_dir, args.excel_dirs, args.values_dir, args.jobs)
+    else:
+        export_to_excel(args.report_dir, args.excel_dirs, args.jobs, args.interactive)